@@ -3,6 +3,7 @@ import json
 import requests
 import wolframalpha
 from googleapiclient.discovery import build
+import httplib2
 from bs4 import BeautifulSoup
 from litellm import completion
 from dotenv import load_dotenv
@@ -21,7 +22,6 @@ import pyaudio
 import io
 import argparse
 import tempfile
-import asyncio
 import re
 import threading
 import queue
@@ -31,12 +31,17 @@ import tempfile
 import uuid
 import os
 import numpy as np
+from collections import OrderedDict, deque
+from types import MappingProxyType
+from typing import NamedTuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
 load_dotenv()
 
 app = Flask(__name__)
 
-audio_streams = {}
+audio_streams = {}  # audio id -> (generator, cancel token), until /stream_audio picks it up
+streaming_audio = {}  # audio id -> cancel token, while /stream_audio is sending it
 client = Cartesia(api_key=os.environ.get("CARTESIA_API_KEY"))
 voice_id = "87748186-23bb-4158-a1eb-332911b0b708"
 voice = client.voices.get(id=voice_id)
@@ -52,8 +57,16 @@ GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 GOOGLE_CSE_ID = os.getenv("GOOGLE_CSE_ID")
 WOLFRAM_ALPHA_APP_ID = os.getenv("WOLFRAM_ALPHA_APP_ID")
 
+# Seconds before an upstream call is abandoned, so cancelled calls cannot hold a worker for long
+UPSTREAM_TIMEOUT = 30
 
-google_service = build("customsearch", "v1", developerKey=GOOGLE_API_KEY)
+
+google_service = build(
+    "customsearch",
+    "v1",
+    developerKey=GOOGLE_API_KEY,
+    http=httplib2.Http(timeout=UPSTREAM_TIMEOUT),
+)
 
 wolfram_client = wolframalpha.Client(WOLFRAM_ALPHA_APP_ID)
 
@@ -63,6 +76,274 @@ audio_thread = None
 audio_stream = None
 audio_paused = threading.Event()
 CURRENT_MODEL = "gemini/gemini-1.5-flash"
+SPECULATION_ENABLED = False
+
+# Seconds between keep-alive newlines on /generate, also bounds disconnect detection
+HEARTBEAT_INTERVAL = 1.0
+
+# Open-Meteo weather codes mapped to human readable conditions
+WEATHER_CONDITIONS = {
+    0: "Clear sky",
+    1: "Mainly clear", 2: "Partly cloudy", 3: "Overcast",
+    45: "Fog", 48: "Depositing rime fog",
+    51: "Light drizzle", 53: "Moderate drizzle", 55: "Dense drizzle",
+    61: "Slight rain", 63: "Moderate rain", 65: "Heavy rain",
+    71: "Slight snow fall", 73: "Moderate snow fall", 75: "Heavy snow fall",
+    77: "Snow grains",
+    80: "Slight rain showers", 81: "Moderate rain showers", 82: "Violent rain showers",
+    85: "Slight snow showers", 86: "Heavy snow showers",
+    95: "Thunderstorm", 96: "Thunderstorm with slight hail", 99: "Thunderstorm with heavy hail"
+}
+
+
+class GenerationCancelled(Exception):
+    """Raised when a generation is cancelled mid-flight"""
+
+
+class CancellationToken:
+    """Thread-safe flag shared by every stage of a single generation.
+
+    A child token is also cancelled with its parent, but can be cancelled on
+    its own without affecting the rest of the generation.
+    """
+
+    def __init__(self, session_id=None, parent=None):
+        self.session_id = session_id
+        self.parent = parent
+        self._event = threading.Event()
+
+    def child(self):
+        return CancellationToken(self.session_id, parent=self)
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set() or (self.parent is not None and self.parent.cancelled)
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise GenerationCancelled()
+
+
+# Worker pool for blocking upstream calls so callers can stop waiting on cancel
+upstream_executor = ThreadPoolExecutor(max_workers=16)
+# Wolfram Alpha calls cannot be timed out client-side, so a hung call only ties up this pool
+wolfram_executor = ThreadPoolExecutor(max_workers=4)
+
+# The in-flight generation token for each session id
+active_generations = {}
+active_generations_lock = threading.Lock()
+
+
+def run_cancellable(cancel_token, func, *args, executor=None, **kwargs):
+    """Run a blocking upstream call, returning early with GenerationCancelled on cancel"""
+    if cancel_token is None:
+        return func(*args, **kwargs)
+
+    cancel_token.raise_if_cancelled()
+    future = (executor or upstream_executor).submit(func, *args, **kwargs)
+    while True:
+        try:
+            return future.result(timeout=0.1)
+        except FutureTimeoutError:
+            if cancel_token.cancelled:
+                future.cancel()
+                raise GenerationCancelled()
+
+
+def start_generation(session_id):
+    """Register a new generation for a session, cancelling any previous one (barge-in)"""
+    cancel_token = CancellationToken(session_id)
+    with active_generations_lock:
+        previous = active_generations.get(session_id)
+        active_generations[session_id] = cancel_token
+    if previous:
+        previous.cancel()
+    return cancel_token
+
+
+def finish_generation(session_id, cancel_token):
+    """Forget a session's generation if it is still the active one"""
+    with active_generations_lock:
+        if active_generations.get(session_id) is cancel_token:
+            del active_generations[session_id]
+
+
+def cancel_generations(session_id=None):
+    """Cancel the generation and assistant audio for a session, or for every session when none is given"""
+    with active_generations_lock:
+        if session_id is None:
+            tokens = list(active_generations.values())
+            active_generations.clear()
+        else:
+            token = active_generations.pop(session_id, None)
+            tokens = [token] if token else []
+
+    # Audio from a finished generation is still tied to its token
+    audio_tokens = [token for _, token in list(audio_streams.values())] + list(streaming_audio.values())
+    tokens += [
+        token
+        for token in audio_tokens
+        if token is not None and (session_id is None or token.session_id == session_id)
+    ]
+    for token in tokens:
+        token.cancel()
+    drop_cancelled_audio_streams()
+
+
+def drop_cancelled_audio_streams():
+    """Close pending TTS streams of cancelled generations that nobody has started streaming"""
+    for audio_id, (_, token) in list(audio_streams.items()):
+        if token is None or not token.cancelled:
+            continue
+        # Whoever pops the entry owns it, so a stream being sent elsewhere is never touched
+        entry = audio_streams.pop(audio_id, None)
+        if entry and hasattr(entry[0], "close"):
+            entry[0].close()
+
+
+class UpstreamBusy(Exception):
+    """Raised when an upstream's wait queue is full or the wait would be too long"""
+
+
+class UpstreamLimiter:
+    """Token bucket for one upstream API with a fair, bounded wait queue.
+
+    Callers that cannot get a token immediately queue under their session id.
+    Sessions are served round-robin, so one busy session only delays its own
+    calls, and callers are turned away at once when the queue is full or the
+    expected wait exceeds ``max_wait``.
+    """
+
+    def __init__(self, name, rate, burst, max_queue=32, max_wait=15):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._cond = threading.Condition()
+        self._queues = OrderedDict()  # session id -> deque of waiters
+        self._depth = 0
+        self._admitted = 0
+        self._rejected = 0
+        self._total_wait = 0.0
+        self._longest_wait = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _admit(self, waited):
+        self._tokens -= 1
+        self._admitted += 1
+        self._total_wait += waited
+        self._longest_wait = max(self._longest_wait, waited)
+
+    def _dequeue(self, session_id, waiter):
+        waiters = self._queues.get(session_id)
+        if waiters is None or waiter not in waiters:
+            return
+        waiters.remove(waiter)
+        self._depth -= 1
+        if waiters:
+            # Send the session to the back of the line so others get a turn
+            self._queues.move_to_end(session_id)
+        else:
+            del self._queues[session_id]
+        self._cond.notify_all()
+
+    def acquire(self, session_id=None, cancel_token=None):
+        """Block until this upstream may be called, in fair order across sessions"""
+        with self._cond:
+            self._refill()
+            if not self._depth and self._tokens >= 1:
+                self._admit(0.0)
+                return
+
+            expected_wait = (self._depth + 1 - self._tokens) / self.rate
+            if self._depth >= self.max_queue or expected_wait > self.max_wait:
+                self._rejected += 1
+                raise UpstreamBusy(f"{self.name} is busy, try again shortly")
+
+            waiter = object()
+            self._queues.setdefault(session_id, deque()).append(waiter)
+            self._depth += 1
+            started = time.monotonic()
+            try:
+                while True:
+                    self._refill()
+                    head_session = next(iter(self._queues))
+                    if self._queues[head_session][0] is waiter and self._tokens >= 1:
+                        self._admit(time.monotonic() - started)
+                        return
+                    if cancel_token is not None:
+                        cancel_token.raise_if_cancelled()
+                    if time.monotonic() - started > self.max_wait:
+                        self._rejected += 1
+                        raise UpstreamBusy(f"{self.name} is busy, try again shortly")
+                    self._cond.wait(timeout=0.1)
+            finally:
+                self._dequeue(session_id, waiter)
+
+    def try_acquire(self, spare=0):
+        """Take a token only if nobody is queued and ``spare`` more would remain"""
+        with self._cond:
+            self._refill()
+            if self._depth or self._tokens < 1 + spare:
+                return False
+            self._admit(0.0)
+            return True
+
+    def stats(self):
+        with self._cond:
+            self._refill()
+            return {
+                "queue_depth": self._depth,
+                "waiting_sessions": len(self._queues),
+                "available_tokens": round(self._tokens, 2),
+                "admitted": self._admitted,
+                "rejected": self._rejected,
+                "average_wait": round(self._total_wait / self._admitted, 3) if self._admitted else 0.0,
+                "longest_wait": round(self._longest_wait, 3),
+            }
+
+
+# Default (requests, per seconds, burst) for each quota-limited upstream. The refill over
+# one window plus the burst stays within the documented quota, so a full bucket cannot
+# overshoot it. Override with e.g. LLM_RATE_LIMIT=1000/60 and LLM_BURST=20.
+UPSTREAM_QUOTAS = {
+    "llm": (12, 60, 3),  # Gemini free tier: 15 requests per minute
+    "google_search": (90, 24 * 60 * 60, 10),  # Custom Search JSON API: 100 free queries per day
+    "wolfram_alpha": (1990, 30 * 24 * 60 * 60, 10),  # Wolfram|Alpha free API: 2,000 calls per month
+    "cartesia": (60, 60, 4),  # Cartesia bills characters, so only smooth out request bursts
+}
+
+
+def load_upstream_limiter(name):
+    """Build an upstream's limiter from its default quota and any environment overrides"""
+    requests_allowed, window, burst = UPSTREAM_QUOTAS[name]
+    rate_limit = os.getenv(f"{name.upper()}_RATE_LIMIT")
+    if rate_limit:
+        requests_allowed, _, window = rate_limit.partition("/")
+        requests_allowed, window = float(requests_allowed), float(window or 1)
+    burst = float(os.getenv(f"{name.upper()}_BURST", burst))
+    return UpstreamLimiter(name, rate=requests_allowed / window, burst=burst)
+
+
+upstream_limiters = {name: load_upstream_limiter(name) for name in UPSTREAM_QUOTAS}
+
+
+def call_upstream(upstream, cancel_token, func, *args, **kwargs):
+    """Wait for a rate limit slot on an upstream, then run the call cancellably"""
+    session_id = cancel_token.session_id if cancel_token is not None else None
+    upstream_limiters[upstream].acquire(session_id, cancel_token)
+    executor = wolfram_executor if upstream == "wolfram_alpha" else upstream_executor
+    return run_cancellable(cancel_token, func, *args, executor=executor, **kwargs)
 
 
 def get_music_files():
@@ -78,45 +359,55 @@ def get_music_files():
     return []
 
 
+def geocode_location(location):
+    """Look up the coordinates of a location using the Open-Meteo geocoding API"""
+    try:
+        response = requests.get(
+            "https://geocoding-api.open-meteo.com/v1/search",
+            params={"name": location, "count": 1},
+            timeout=10,
+        )
+    except requests.RequestException as e:
+        return None, f"Error in geocoding request: {e}"
+    if response.status_code != 200:
+        return None, f"Error in geocoding request: {response.status_code}"
+    data = response.json()
+    if "results" in data and data["results"]:
+        return (data["results"][0]["latitude"], data["results"][0]["longitude"]), None
+    return None, f"No results found for {location}"
+
+
 def get_current_weather(location, unit="celsius"):
     """Get the current weather in a given location using the Open-Meteo API"""
 
-    # Geocoding API endpoint
-    geocoding_url = (
-        f"https://geocoding-api.open-meteo.com/v1/search?name={location}&count=1"
-    )
-
     # Get coordinates for the location
-    response = requests.get(geocoding_url)
-    if response.status_code == 200:
-        data = response.json()
-        if "results" in data and data["results"]:
-            lat = data["results"][0]["latitude"]
-            lon = data["results"][0]["longitude"]
-        else:
-            return json.dumps(
-                {
-                    "location": location,
-                    "temperature": "unknown",
-                    "condition": "unknown",
-                    "error": f"No results found for {location}",
-                }
-            )
-    else:
+    coords, error = geocode_location(location)
+    if error:
         return json.dumps(
             {
                 "location": location,
                 "temperature": "unknown",
                 "condition": "unknown",
-                "error": f"Error in geocoding request: {response.status_code}",
+                "error": error,
             }
         )
+    lat, lon = coords
 
     # Weather API endpoint
     weather_url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&current_weather=true&weathercode=true"
 
     # Get current weather data
-    response = requests.get(weather_url)
+    try:
+        response = requests.get(weather_url, timeout=10)
+    except requests.RequestException as e:
+        return json.dumps(
+            {
+                "location": location,
+                "temperature": "unknown",
+                "condition": "unknown",
+                "error": f"Error in weather request: {e}",
+            }
+        )
     if response.status_code == 200:
         data = response.json()
         if "current_weather" in data and "temperature" in data["current_weather"]:
@@ -128,19 +419,7 @@ def get_current_weather(location, unit="celsius"):
                 temperature = (temperature * 9 / 5) + 32
 
             # Map weather code to condition
-            weather_conditions = {
-                0: "Clear sky",
-                1: "Mainly clear", 2: "Partly cloudy", 3: "Overcast",
-                45: "Fog", 48: "Depositing rime fog",
-                51: "Light drizzle", 53: "Moderate drizzle", 55: "Dense drizzle",
-                61: "Slight rain", 63: "Moderate rain", 65: "Heavy rain",
-                71: "Slight snow fall", 73: "Moderate snow fall", 75: "Heavy snow fall",
-                77: "Snow grains",
-                80: "Slight rain showers", 81: "Moderate rain showers", 82: "Violent rain showers",
-                85: "Slight snow showers", 86: "Heavy snow showers",
-                95: "Thunderstorm", 96: "Thunderstorm with slight hail", 99: "Thunderstorm with heavy hail"
-            }
-            condition = weather_conditions.get(weather_code, "Unknown")
+            condition = WEATHER_CONDITIONS.get(weather_code, "Unknown")
 
             return json.dumps(
                 {
@@ -170,9 +449,78 @@ def get_current_weather(location, unit="celsius"):
         )
 
 
+def get_weather_for_locations(locations, unit="celsius"):
+    """Get the current weather for several locations with one Open-Meteo forecast request"""
+    if not locations:
+        return json.dumps([])
+
+    # Geocode every location at the same time
+    with ThreadPoolExecutor(max_workers=min(len(locations), 8)) as executor:
+        geocoded = list(executor.map(geocode_location, locations))
+
+    results = [
+        {
+            "location": location,
+            "temperature": "unknown",
+            "condition": "unknown",
+            "error": error,
+        }
+        for location, (_, error) in zip(locations, geocoded)
+    ]
+    resolved = [i for i, (coords, _) in enumerate(geocoded) if coords]
+    if not resolved:
+        return json.dumps(results)
+
+    # Open-Meteo accepts comma separated coordinate lists and returns one entry per pair
+    latitudes = ",".join(str(geocoded[i][0][0]) for i in resolved)
+    longitudes = ",".join(str(geocoded[i][0][1]) for i in resolved)
+    try:
+        response = requests.get(
+            "https://api.open-meteo.com/v1/forecast",
+            params={
+                "latitude": latitudes,
+                "longitude": longitudes,
+                "current_weather": "true",
+            },
+            timeout=10,
+        )
+    except requests.RequestException as e:
+        for i in resolved:
+            results[i]["error"] = f"Error in weather request: {e}"
+        return json.dumps(results)
+    if response.status_code != 200:
+        for i in resolved:
+            results[i]["error"] = f"Error in weather request: {response.status_code}"
+        return json.dumps(results)
+
+    data = response.json()
+    if isinstance(data, dict):
+        data = [data]
+
+    for i, entry in zip(resolved, data):
+        current = entry.get("current_weather", {})
+        if "temperature" not in current:
+            results[i]["error"] = "Weather data not found in the response"
+            continue
+
+        temperature = current["temperature"]
+        if unit == "fahrenheit":
+            temperature = (temperature * 9 / 5) + 32
+
+        results[i] = {
+            "location": locations[i],
+            "temperature": round(temperature, 1),
+            "unit": unit,
+            "condition": WEATHER_CONDITIONS.get(current.get("weathercode"), "Unknown"),
+        }
+
+    return json.dumps(results)
+
+
 def query_wolfram_alpha(query):
     """Query Wolfram Alpha for information"""
-    res = wolfram_client.query(query)
+    # Ask Wolfram Alpha to give up server-side rather than keep the call open
+    res = wolfram_client.query(query, totaltimeout=UPSTREAM_TIMEOUT)
     try:
         return next(res.results).text
     except StopIteration:
@@ -206,9 +554,8 @@ def audio_streaming_thread(filename):
             else:
                 time.sleep(0.1)
 
-        if audio_stream:
-            stream.stop_stream()
-            stream.close()
+        stream.stop_stream()
+        stream.close()
         p.terminate()
     except Exception as e:
         print(f"Error in audio streaming: {str(e)}")
@@ -221,11 +568,21 @@ def audio_streaming_thread(filename):
 def stream_audio(audio_id):
     def generate():
         try:
-            output = audio_streams.get(audio_id)
-            if output:
-                for chunk in output:
-                    yield chunk['audio']
-                del audio_streams[audio_id]  # Clean up after streaming
+            # Take ownership of the stream so cancellation no longer closes it from another thread
+            entry = audio_streams.pop(audio_id, None)
+            if entry:
+                output, cancel_token = entry
+                streaming_audio[audio_id] = cancel_token
+                try:
+                    for chunk in output:
+                        if cancel_token is not None and cancel_token.cancelled:
+                            break
+                        yield chunk['audio']
+                finally:
+                    # Stop the upstream TTS stream if we bail out early
+                    if hasattr(output, "close"):
+                        output.close()
+                    streaming_audio.pop(audio_id, None)  # Clean up after streaming
         except Exception as e:
             print(f"Error streaming audio: {e}")
 
@@ -272,7 +629,7 @@ def pause_music():
         return "No music is currently playing."
 
 
-def download_audio(url, output_folder="music"):
+def download_audio(url, output_folder="music", cancel_token=None):
     # Ensure output folder exists
     os.makedirs(output_folder, exist_ok=True)
 
@@ -289,18 +646,28 @@ def download_audio(url, output_folder="music"):
             {"key": "FFmpegMetadata"},  # Adds metadata tags if available
         ],
         "noplaylist": True,  # Download only the single video
+        "socket_timeout": UPSTREAM_TIMEOUT,
     }
 
+    if cancel_token is not None:
+        # yt-dlp aborts the download when a progress hook raises
+        def check_cancelled(_):
+            cancel_token.raise_if_cancelled()
+
+        ydl_opts["progress_hooks"] = [check_cancelled]
+
     # Download and convert to MP3
     with yt_dlp.YoutubeDL(ydl_opts) as ydl:
         try:
             info = ydl.extract_info(url, download=True)
             return f"Successfully downloaded: {info['title']}"
         except Exception as e:
+            if cancel_token is not None and cancel_token.cancelled:
+                raise GenerationCancelled() from e
             return f"Error downloading audio: {str(e)}"
 
 
-def summarize_tool_result(tool_name: str, result: str, original_query: str) -> str:
+def summarize_tool_result(tool_name: str, result: str, original_query: str, cancel_token=None) -> str:
     """Use the LLM to summarize tool results in a natural way"""
     summary_prompt = f"""Please summarize the following {tool_name} result in a natural, conversational way. 
     Original query: {original_query}
@@ -308,8 +675,12 @@ def summarize_tool_result(tool_name: str, result: str, original_query: str) -> s
     
     Provide a concise, clear summary that a user would find helpful and easy to understand."""
 
-    summary_response = completion(
+    summary_response = call_upstream(
+        "llm",
+        cancel_token,
+        completion,
         model="gemini/gemini-1.5-flash",
+        timeout=UPSTREAM_TIMEOUT,
         messages=[
             {
                 "role": "system",
@@ -362,141 +733,169 @@ def scrape_content(url):
         return ""
 
 
-def get_available_tools(profile):
-    """Get the list of available tools based on profile configuration"""
-    available_tools = []
-
-    if profile["tools"].get("weather", True):
-        available_tools.append(
-            {
-                "type": "function",
-                "function": {
-                    "name": "get_current_weather",
-                    "description": "Get the current weather in a given location using live data from Open-Meteo",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "location": {
-                                "type": "string",
-                                "description": "The city name, e.g. San Francisco",
-                            },
-                            "unit": {
-                                "type": "string",
-                                "enum": ["celsius", "fahrenheit"],
-                                "description": "The temperature unit to use (default is celsius)",
-                            },
+# Tool schemas offered to the model, keyed by name with the profile flag that enables them
+TOOL_SCHEMAS = {
+    "get_current_weather": (
+        "weather",
+        {
+            "type": "function",
+            "function": {
+                "name": "get_current_weather",
+                "description": "Get the current weather in a given location using live data from Open-Meteo",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "location": {
+                            "type": "string",
+                            "description": "The city name, e.g. San Francisco",
+                        },
+                        "unit": {
+                            "type": "string",
+                            "enum": ["celsius", "fahrenheit"],
+                            "description": "The temperature unit to use (default is celsius)",
                         },
-                        "required": ["location"],
                     },
+                    "required": ["location"],
                 },
-            }
-        )
-
-    if profile["tools"].get("wolfram_alpha", True):
-        available_tools.append(
-            {
-                "type": "function",
-                "function": {
-                    "name": "query_wolfram_alpha",
-                    "description": "Query Wolfram Alpha for information or calculations",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "query": {
-                                "type": "string",
-                                "description": "The query to send to Wolfram Alpha",
-                            }
+            },
+        },
+    ),
+    "get_weather_for_locations": (
+        "weather",
+        {
+            "type": "function",
+            "function": {
+                "name": "get_weather_for_locations",
+                "description": "Get the current weather for several locations at once, e.g. to compare cities",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "locations": {
+                            "type": "array",
+                            "items": {"type": "string"},
+                            "description": "The city names, e.g. [\"London\", \"Paris\", \"Berlin\"]",
+                        },
+                        "unit": {
+                            "type": "string",
+                            "enum": ["celsius", "fahrenheit"],
+                            "description": "The temperature unit to use (default is celsius)",
                         },
-                        "required": ["query"],
                     },
+                    "required": ["locations"],
                 },
-            }
-        )
-
-    if profile["tools"].get("google_search", True):
-        available_tools.append(
-            {
-                "type": "function",
-                "function": {
-                    "name": "google_search",
-                    "description": "Perform a Google search and summarize the top results",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "query": {
-                                "type": "string",
-                                "description": "The search query to send to Google",
-                            }
-                        },
-                        "required": ["query"],
+            },
+        },
+    ),
+    "query_wolfram_alpha": (
+        "wolfram_alpha",
+        {
+            "type": "function",
+            "function": {
+                "name": "query_wolfram_alpha",
+                "description": "Query Wolfram Alpha for information or calculations",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "query": {
+                            "type": "string",
+                            "description": "The query to send to Wolfram Alpha",
+                        }
                     },
+                    "required": ["query"],
                 },
-            }
-        )
-
-    if profile["tools"].get("play_music", True):
-        available_tools.append(
-            {
-                "type": "function",
-                "function": {
-                    "name": "play_music",
-                    "description": "Play a song from the user's music directory",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "song_name": {
-                                "type": "string",
-                                "description": "The name of the song to play",
-                            }
-                        },
-                        "required": ["song_name"],
+            },
+        },
+    ),
+    "google_search": (
+        "google_search",
+        {
+            "type": "function",
+            "function": {
+                "name": "google_search",
+                "description": "Perform a Google search and summarize the top results",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "query": {
+                            "type": "string",
+                            "description": "The search query to send to Google",
+                        }
                     },
+                    "required": ["query"],
                 },
-            }
-        )
-
-        available_tools.append(
-            {
-                "type": "function",
-                "function": {
-                    "name": "pause_music",
-                    "description": "Pause the currently playing music",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "confirmation": {
-                                "type": "boolean",
-                                "description": "Confirmation to pause the music (always true)",
-                            }
-                        },
-                        "required": [],
+            },
+        },
+    ),
+    "play_music": (
+        "play_music",
+        {
+            "type": "function",
+            "function": {
+                "name": "play_music",
+                "description": "Play a song from the user's music directory",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "song_name": {
+                            "type": "string",
+                            "description": "The name of the song to play",
+                        }
                     },
+                    "required": ["song_name"],
                 },
-            }
-        )
-
-    if profile["tools"].get("download_audio", True):
-        available_tools.append(
-            {
-                "type": "function",
-                "function": {
-                    "name": "download_audio",
-                    "description": "Download audio from a YouTube video and save it to the music directory",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "url": {
-                                "type": "string",
-                                "description": "The YouTube video URL",
-                            }
-                        },
-                        "required": ["url"],
+            },
+        },
+    ),
+    "pause_music": (
+        "play_music",
+        {
+            "type": "function",
+            "function": {
+                "name": "pause_music",
+                "description": "Pause the currently playing music",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "confirmation": {
+                            "type": "boolean",
+                            "description": "Confirmation to pause the music (always true)",
+                        }
                     },
+                    "required": [],
                 },
-            }
-        )
+            },
+        },
+    ),
+    "download_audio": (
+        "download_audio",
+        {
+            "type": "function",
+            "function": {
+                "name": "download_audio",
+                "description": "Download audio from a YouTube video and save it to the music directory",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "url": {
+                            "type": "string",
+                            "description": "The YouTube video URL",
+                        }
+                    },
+                    "required": ["url"],
+                },
+            },
+        },
+    ),
+}
 
-    return available_tools
+
+def get_available_tools(profile):
+    """Get the list of available tools based on profile configuration"""
+    return [
+        schema
+        for flag, schema in TOOL_SCHEMAS.values()
+        if profile["tools"].get(flag, True)
+    ]
 
 
 def get_default_profile():
@@ -531,20 +930,513 @@ You have been provided with this information about the user's music directory. Y
     
 
 
+def run_weather_tool(function_args, cancel_token=None, prefetched=None):
+    weather_result = prefetched
+    if weather_result is None:
+        weather_result = run_cancellable(cancel_token, get_current_weather, **function_args)
+    return summarize_tool_result("weather", weather_result, f"Weather in {function_args.get('location')}", cancel_token)
+
+
+def run_multi_weather_tool(function_args, cancel_token=None):
+    weather_result = run_cancellable(cancel_token, get_weather_for_locations, **function_args)
+    return summarize_tool_result("weather", weather_result, f"Weather in {', '.join(function_args.get('locations', []))}", cancel_token)
+
+
+def run_wolfram_alpha_tool(function_args, cancel_token=None):
+    query = function_args["query"]
+    wolfram_result = call_upstream("wolfram_alpha", cancel_token, query_wolfram_alpha, query)
+    return summarize_tool_result("Wolfram Alpha", wolfram_result, query, cancel_token)
+
+
+def run_play_music_tool(function_args, cancel_token=None):
+    song_name = function_args.get("song_name")
+    if song_name:
+        return play_music(song_name)
+    return None
+
+
+def run_pause_music_tool(function_args, cancel_token=None):
+    return pause_music()
+
+
+def run_download_audio_tool(function_args, cancel_token=None):
+    return download_audio(function_args["url"], cancel_token=cancel_token)
+
+
+def search_and_scrape(query, cancel_token=None, admitted=False):
+    """Search Google and scrape each result, returning the combined results as JSON.
+
+    Pass ``admitted=True`` when the caller has already taken a rate limit token.
+    """
+    if admitted:
+        search_results = run_cancellable(cancel_token, google_search, query)
+    else:
+        search_results = call_upstream("google_search", cancel_token, google_search, query)
+    scraped_content = []
+    for result in search_results:
+        title = result.get("title", "")
+        url = result.get("link", "")
+        snippet = result.get("snippet", "")
+        page_content = run_cancellable(cancel_token, scrape_content, url)
+        scraped_content.append({
+            "title": title,
+            "url": url,
+            "snippet": snippet,
+            "content": page_content,
+        })
+    return json.dumps(scraped_content)
+
+
+def run_google_search_tool(function_args, cancel_token=None, prefetched=None):
+    query = function_args["query"]
+    search_result_json = prefetched
+    if search_result_json is None:
+        search_result_json = search_and_scrape(query, cancel_token)
+    return summarize_tool_result("Google Search", search_result_json, query, cancel_token)
+
+
+# Handlers for each tool call, returning the text to append to the reply
+TOOL_HANDLERS = {
+    "get_current_weather": run_weather_tool,
+    "get_weather_for_locations": run_multi_weather_tool,
+    "query_wolfram_alpha": run_wolfram_alpha_tool,
+    "play_music": run_play_music_tool,
+    "pause_music": run_pause_music_tool,
+    "download_audio": run_download_audio_tool,
+    "google_search": run_google_search_tool,
+}
+
+# Local intent rules for speculation: pattern, tool name and the argument the match fills
+SPECULATION_RULES = [
+    (
+        re.compile(r"\bweather\b.*?\b(?:in|for|at)\s+([a-z][\w\s,.'-]*?)\s*(?:today|right now|now|currently)?\s*[?.!]*$", re.IGNORECASE),
+        "get_current_weather",
+        "location",
+    ),
+    (
+        re.compile(r"^(?:please\s+)?(?:search(?:\s+the\s+web)?(?:\s+for)?|google|look\s+up)\s+(.+?)\s*[?.!]*$", re.IGNORECASE),
+        "google_search",
+        "query",
+    ),
+]
+
+
+def speculative_weather(function_args, cancel_token=None):
+    # The geocoder only understands the place name, not "Paris, France"
+    location = function_args["location"].split(",")[0].strip()
+    return get_current_weather(location)
+
+
+def speculative_search(function_args, cancel_token=None):
+    # Speculation.start has already taken the rate limit token
+    return search_and_scrape(function_args["query"], cancel_token, admitted=True)
+
+
+# Side-effect free fetches that may run before the model has picked a tool
+SPECULATIVE_FETCHERS = {
+    "get_current_weather": speculative_weather,
+    "google_search": speculative_search,
+}
+
+# Rate-limited upstreams a speculation may only use while tokens are to spare,
+# so a wrong guess never leaves the model's real call waiting or rejected
+SPECULATIVE_UPSTREAMS = {
+    "google_search": "google_search",
+}
+
+
+def speculation_key(function_name, function_args):
+    """Reduce tool arguments to what decides the result, so equivalent calls compare equal"""
+    if function_name == "get_current_weather":
+        location = normalize_query(function_args.get("location", "").split(",")[0])
+        return (function_name, location, function_args.get("unit", "celsius"))
+    return (function_name, normalize_query(function_args.get("query", "")))
+
+
+class SpeculationStats:
+    """Counters for tuning the speculation rules"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def record(self, function_name, outcome):
+        with self._lock:
+            counts = self._counts.setdefault(function_name, {"started": 0, "hits": 0, "wasted": 0})
+            counts[outcome] += 1
+
+    def stats(self):
+        with self._lock:
+            report = {}
+            for function_name, counts in self._counts.items():
+                finished = counts["hits"] + counts["wasted"]
+                report[function_name] = dict(counts, hit_rate=round(counts["hits"] / finished, 3) if finished else 0.0)
+            return report
+
+
+speculation_stats = SpeculationStats()
+speculation_executor = ThreadPoolExecutor(max_workers=4)
+
+
+class Speculation:
+    """A tool call started from the user's message while the model is still deciding"""
+
+    def __init__(self, function_name, function_args, cancel_token=None):
+        self.function_name = function_name
+        self.key = speculation_key(function_name, function_args)
+        self._claimed = False
+        # Its own token, so discarding it stops the fetch without touching the generation
+        self._cancel_token = cancel_token.child() if cancel_token is not None else CancellationToken()
+        self._future = speculation_executor.submit(
+            SPECULATIVE_FETCHERS[function_name], function_args, self._cancel_token
+        )
+        speculation_stats.record(function_name, "started")
+
+    @classmethod
+    def start(cls, message, bundle, cancel_token=None):
+        """Start the first matching rule whose tool the profile allows, if any"""
+        for pattern, function_name, argument in SPECULATION_RULES:
+            if function_name not in bundle.dispatch:
+                continue
+            match = pattern.search(message)
+            if not match:
+                continue
+            upstream = SPECULATIVE_UPSTREAMS.get(function_name)
+            if upstream and not upstream_limiters[upstream].try_acquire(spare=1):
+                return None
+            return cls(function_name, {argument: match.group(1).strip()}, cancel_token)
+        return None
+
+    def claim(self, function_name, function_args, cancel_token=None):
+        """Return the speculative result if the model asked for the same call, else None"""
+        if self._claimed or speculation_key(function_name, function_args) != self.key:
+            return None
+        try:
+            # Wait on this thread rather than a pool worker the fetch itself may need
+            while True:
+                try:
+                    result = self._future.result(timeout=0.1)
+                    break
+                except FutureTimeoutError:
+                    if cancel_token is not None:
+                        cancel_token.raise_if_cancelled()
+        except GenerationCancelled:
+            raise
+        except Exception as e:
+            print(f"Speculative {self.function_name} failed: {e}")
+            return None
+        self._claimed = True
+        speculation_stats.record(self.function_name, "hits")
+        return result
+
+    def discard(self):
+        """Drop an unclaimed speculation, counting it as wasted"""
+        if not self._claimed:
+            self._claimed = True
+            self._future.cancel()
+            self._cancel_token.cancel()
+            speculation_stats.record(self.function_name, "wasted")
+
+
+TIME_SENTENCE_PATTERN = re.compile(r"The current time is .*? and the date is .*?\.", re.IGNORECASE)
+PROMPT_INSTRUCTIONS = " PLEASE ALWAYS USE CELSIUS FOR WEATHER UNLESS ASKED OTHERWISE. ALWAYS CALL ONE FUNCTION IN ANY RESPONSE"
+
+
+class ProfileBundle(NamedTuple):
+    """A profile precompiled into everything a request needs"""
+
+    profile_id: str
+    tools: tuple
+    dispatch: MappingProxyType
+    prompt_prefix: str
+    prompt_suffix: str
+
+    def render_prompt(self):
+        """Fill the current date and time into the system prompt"""
+        current_time = datetime.now()
+        formatted_date = current_time.strftime("%A, %B %d, %Y")
+        formatted_time = current_time.strftime("%I:%M %p")
+        return f"{self.prompt_prefix}The current time is {formatted_time} and the date is {formatted_date}.{self.prompt_suffix}"
+
+
+def compile_profile(profile, profile_id=None):
+    """Precompile a profile dict into an immutable ProfileBundle"""
+    tools = get_available_tools(profile)
+    enabled = {schema["function"]["name"] for schema in tools}
+    dispatch = MappingProxyType(
+        {name: handler for name, handler in TOOL_HANDLERS.items() if name in enabled}
+    )
+
+    # Split the prompt around its time sentence, appending one if it has none
+    system_prompt = profile["personality"]["system_prompt"]
+    match = TIME_SENTENCE_PATTERN.search(system_prompt)
+    if match:
+        prompt_prefix = system_prompt[: match.start()]
+        prompt_suffix = system_prompt[match.end() :]
+    else:
+        prompt_prefix = system_prompt + " "
+        prompt_suffix = PROMPT_INSTRUCTIONS
+
+    return ProfileBundle(profile_id, tuple(tools), dispatch, prompt_prefix, prompt_suffix)
+
+
+default_bundle_cache = {}
+
+
+def get_default_bundle():
+    """Get the compiled default profile, recompiling only when the music directory changes"""
+    music_files = tuple(get_music_files())
+    bundle = default_bundle_cache.get(music_files)
+    if bundle is None:
+        bundle = compile_profile(get_default_profile(), "default")
+        default_bundle_cache.clear()
+        default_bundle_cache[music_files] = bundle
+    return bundle
+
+
+class ProfileRegistry:
+    """Profiles loaded from a directory of JSON files, recompiled when a file changes"""
+
+    def __init__(self, directory, poll_interval=2):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self._bundles = {}
+        self._mtimes = {}
+        self._watch_thread = None
+
+    def get(self, profile_id):
+        return self._bundles.get(profile_id)
+
+    def ids(self):
+        return sorted(self._bundles)
+
+    def load(self):
+        """Scan the directory, recompiling new or modified profiles and dropping deleted ones"""
+        if not os.path.isdir(self.directory):
+            return
+
+        bundles = dict(self._bundles)
+        seen = set()
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, file_name)
+            profile_id = os.path.splitext(file_name)[0]
+            seen.add(profile_id)
+            try:
+                mtime = os.path.getmtime(path)
+                if self._mtimes.get(profile_id) == mtime:
+                    continue
+                self._mtimes[profile_id] = mtime
+                with open(path) as f:
+                    bundles[profile_id] = compile_profile(json.load(f), profile_id)
+                print(f"[bold blue]Loaded profile '{profile_id}'[/bold blue]")
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                print(f"Error loading profile {path}: {e}")
+
+        for profile_id in set(bundles) - seen:
+            del bundles[profile_id]
+            self._mtimes.pop(profile_id, None)
+
+        # Swap in a new dict so readers never see a half-updated registry
+        self._bundles = bundles
+
+    def start(self):
+        """Load every profile and keep watching the directory for changes"""
+        self.load()
+        self._watch_thread = threading.Thread(target=self._watch, daemon=True)
+        self._watch_thread.start()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.poll_interval)
+            self.load()
+
+
+profile_registry = ProfileRegistry(os.getenv("PROFILES_DIR", "profiles"))
+
+
 def split_into_sentences(text):
     sentences = re.split(r'(?<=[.!?])\s+', text)
     return [sentence.strip() for sentence in sentences if sentence.strip()]    
 
-def speak_text(text, audio_queue):
-    try:
-        cleaned_text = strip_markdown(text)
-        for output in client.tts.sse(
+class TTSConnectionPool:
+    """Pool of long-lived Cartesia websocket connections shared by every request.
+
+    Each utterance checks out one connection and tags its request with its own
+    context id, so the per-utterance HTTP handshake of ``client.tts.sse`` drops
+    out of time-to-first-audio. The synchronous Cartesia websocket reads its
+    replies on the sending thread, so a connection carries one context at a
+    time and concurrency comes from the pool size. When every connection is
+    busy the utterance falls back to a one-off SSE stream. Idle connections are
+    health checked in the background and dead ones are replaced transparently.
+    """
+
+    def __init__(self, cartesia_client, size=4, health_check_interval=30):
+        self.cartesia_client = cartesia_client
+        self.size = size
+        self.health_check_interval = health_check_interval
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._health_thread = None
+
+    def start(self):
+        """Open the warm connections and start the background health checks"""
+        for _ in range(self.size):
+            try:
+                self.release(self._connect())
+            except Exception as e:
+                print(f"Error warming TTS connection: {e}")
+                break
+        self._health_thread = threading.Thread(target=self._health_check_loop, daemon=True)
+        self._health_thread.start()
+
+    def _connect(self):
+        with self._lock:
+            self._created += 1
+        try:
+            ws = self.cartesia_client.tts.websocket()
+            ws.connect()
+            return ws
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    def _discard(self, ws):
+        with self._lock:
+            self._created -= 1
+        try:
+            ws.close()
+        except Exception:
+            pass
+
+    def acquire(self, timeout=2):
+        """Check out a connection, opening a new one if the pool is not full yet.
+
+        Returns None if every connection stays busy for ``timeout`` seconds or a
+        new connection cannot be opened.
+        """
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_grow = self._created < self.size
+        if can_grow:
+            try:
+                return self._connect()
+            except Exception as e:
+                print(f"Error opening TTS connection: {e}")
+                return None
+        try:
+            return self._idle.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def release(self, ws, healthy=True):
+        if healthy and not self._closed.is_set():
+            self._idle.put(ws)
+        else:
+            self._discard(ws)
+
+    def stream(self, transcript, context_id=None, cancel_token=None):
+        """Yield audio chunks for a transcript over a pooled connection"""
+        context_id = context_id or str(uuid.uuid4())
+        session_id = cancel_token.session_id if cancel_token is not None else None
+        upstream_limiters["cartesia"].acquire(session_id, cancel_token)
+        for _ in range(2):
+            ws = self.acquire()
+            if ws is None:
+                break
+            healthy = False
+            started = False
+            try:
+                for output in ws.send(
+                    model_id=model_id,
+                    transcript=transcript,
+                    voice_embedding=voice["embedding"],
+                    context_id=context_id,
+                    output_format=output_format,
+                    stream=True,
+                ):
+                    if cancel_token is not None and cancel_token.cancelled:
+                        return
+                    started = True
+                    yield output
+                healthy = True
+                return
+            except Exception as e:
+                # Retry if nothing reached the listener yet, otherwise the audio would repeat
+                if started:
+                    raise
+                print(f"TTS connection failed: {e}")
+            finally:
+                # A stream abandoned midway leaves unread frames behind, so drop that socket
+                self.release(ws, healthy=healthy)
+
+        # Every pooled connection is busy or broken, so pay for a one-off HTTP stream instead
+        print("No usable TTS connection, falling back to an SSE stream")
+        yield from self._stream_sse(transcript, cancel_token)
+
+    def _stream_sse(self, transcript, cancel_token=None):
+        for output in self.cartesia_client.tts.sse(
             model_id=model_id,
-            transcript=cleaned_text,
+            transcript=transcript,
             voice_embedding=voice["embedding"],
-            stream=True,
             output_format=output_format,
+            stream=True,
         ):
+            if cancel_token is not None and cancel_token.cancelled:
+                return
+            yield output
+
+    def _ping(self, ws, timeout=5):
+        """Round-trip a websocket ping, catching sockets the server dropped silently"""
+        connection = getattr(ws, "websocket", None)
+        if connection is None:
+            return False
+        return connection.ping().wait(timeout)
+
+    def _health_check_loop(self):
+        while not self._closed.wait(self.health_check_interval):
+            for _ in range(self._idle.qsize()):
+                try:
+                    ws = self._idle.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    # connect() only reopens sockets already closed locally, so also ping
+                    ws.connect()
+                    if not self._ping(ws):
+                        raise ConnectionError("no pong received")
+                    self.release(ws)
+                except Exception as e:
+                    print(f"TTS connection failed health check: {e}")
+                    self._discard(ws)
+                    try:
+                        self.release(self._connect())
+                    except Exception as e:
+                        print(f"Error reopening TTS connection: {e}")
+
+    def close(self):
+        self._closed.set()
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+
+tts_pool = TTSConnectionPool(client)
+
+
+def speak_text(text, audio_queue, cancel_token=None):
+    try:
+        cleaned_text = strip_markdown(text)
+        for output in tts_pool.stream(cleaned_text, cancel_token=cancel_token):
             audio_queue.put(output["audio"])
     except Exception as e:
         print(f"Error in speak_text: {e}")
@@ -599,46 +1491,209 @@ def strip_markdown(text):
     
     return text.strip()
 
-def process_tts(text):
-    if not text:
+def record_audio(output, on_complete, cancel_token=None):
+    """Pass audio chunks through, handing the full list to on_complete once streamed"""
+    chunks = []
+    try:
+        for chunk in output:
+            chunks.append({"audio": chunk["audio"]})
+            yield chunk
+        # A cancelled TTS stream ends quietly, so its chunks may be only part of the speech
+        if cancel_token is None or not cancel_token.cancelled:
+            on_complete(chunks)
+    finally:
+        output.close()
+
+
+def process_tts(text, cancel_token=None, on_complete=None):
+    if not text or (cancel_token is not None and cancel_token.cancelled):
         return None
 
     try:
         cleaned_text = strip_markdown(text)
-        output = client.tts.sse(
-            model_id=model_id,
-            transcript=cleaned_text,
-            voice_embedding=voice["embedding"],
-            output_format=output_format,
-            stream=True,
-        )
-        
-        # Generate a unique identifier for this audio stream
+
+        # Generate a unique identifier for this audio stream, doubling as the TTS context id
         audio_id = str(uuid.uuid4())
+        output = tts_pool.stream(cleaned_text, context_id=audio_id, cancel_token=cancel_token)
+        if on_complete:
+            output = record_audio(output, on_complete, cancel_token)
         
         # Store the generator in a dictionary for later retrieval
-        audio_streams[audio_id] = output
+        audio_streams[audio_id] = (output, cancel_token)
         
         return audio_id
     except Exception as e:
         print(f"Error in process_tts: {e}")
         return None
-        
-def generate_content(messages, profile):
-    global CURRENT_MODEL
-    available_tools = get_available_tools(profile)
 
-    system_prompt = profile["personality"]["system_prompt"]
-    if "current time is" not in system_prompt.lower():
-        current_time = datetime.now()
-        formatted_date = current_time.strftime("%A, %B %d, %Y")
-        formatted_time = current_time.strftime("%I:%M %p")
-        system_prompt += f" The current time is {formatted_time} and the date is {formatted_date}. PLEASE ALWAYS USE CELSIUS FOR WEATHER UNLESS ASKED OTHERWISE. ALWAYS CALL ONE FUNCTION IN ANY RESPONSE"
 
-    messages[0]["content"] = system_prompt
+# Seconds a cached answer stays fresh, by the tool that produced it. Plain model answers
+# can depend on the timestamp in the prompt and tools with side effects must always run,
+# so neither is cached. Wolfram Alpha also answers clocks, prices and exchange rates.
+CACHE_TTLS = {
+    "get_current_weather": 10 * 60,
+    "get_weather_for_locations": 10 * 60,
+    "google_search": 60 * 60,
+    "query_wolfram_alpha": 15 * 60,
+}
+
+# Queries asking about the present are only cached for weather, whose TTL already bounds them
+TIME_SENSITIVE_PATTERN = re.compile(
+    r"\b(?:time|now|today|tonight|tomorrow|yesterday|current|currently|latest|live|price|prices|"
+    r"cost|stock|exchange|rate|rates|score|news)\b"
+)
+WEATHER_TOOLS = ("get_current_weather", "get_weather_for_locations")
+
+
+def normalize_query(text):
+    """Lowercase a query and strip punctuation and extra whitespace"""
+    text = re.sub(r"[^\w\s]", " ", text.lower())
+    return " ".join(text.split())
+
+
+# Words that can differ between two phrasings of the same question
+CACHE_STOPWORDS = frozenset(
+    "a an the is are was were be s whats what who whos which where when how please "
+    "tell me can could would you of in on at for to do does did i".split()
+)
+
+
+def content_tokens(query):
+    """The words and numbers of a normalized query that decide its answer"""
+    return tuple(token for token in query.split() if token not in CACHE_STOPWORDS)
+
+
+class ResponseCache:
+    """Answers cached per profile, keyed by the query's content tokens.
+
+    Two phrasings share an answer when they differ only in punctuation, case,
+    whitespace or stopwords ("capital of france?" and "What's the capital of
+    France"). Any other word or number must match exactly, so "2014" vs "2018"
+    or "austria" vs "australia" never do. A profile's entries are dropped as
+    soon as its prompt or tools change, e.g. when its file is reloaded.
+    """
+
+    def __init__(self, max_entries=512, min_words=3):
+        self.max_entries = max_entries
+        self.min_words = min_words
+        self._profiles = {}  # profile id -> {"fingerprint": ..., "entries": {tokens: entry}}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, query):
+        # Short follow-ups like "yes" or "do it" depend on the conversation
+        query = normalize_query(query)
+        if len(query.split()) < self.min_words:
+            return None
+        return content_tokens(query) or None
+
+    def _fingerprint(self, bundle):
+        return (bundle.prompt_prefix, bundle.prompt_suffix, tuple(bundle.dispatch))
+
+    def lookup(self, bundle, query):
+        """Return a fresh cached entry for the query, or None"""
+        key = self._key(query)
+        if key is None:
+            return None
+
+        with self._lock:
+            index = self._profiles.get(bundle.profile_id)
+            entry = None
+            if index and index["fingerprint"] == self._fingerprint(bundle):
+                entry = index["entries"].get(key)
+                if entry and entry["expires"] <= time.time():
+                    del index["entries"][key]
+                    entry = None
+            if entry:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return entry
+
+    def store(self, bundle, query, text, tool_name=None):
+        """Cache an answer, returning the entry so audio can be attached later"""
+        ttl = CACHE_TTLS.get(tool_name, 0)
+        key = self._key(query)
+        if not ttl or key is None:
+            return None
+        if tool_name not in WEATHER_TOOLS and TIME_SENSITIVE_PATTERN.search(normalize_query(query)):
+            return None
+
+        now = time.time()
+        entry = {"text": text, "audio": None, "expires": now + ttl}
+        fingerprint = self._fingerprint(bundle)
+        with self._lock:
+            index = self._profiles.get(bundle.profile_id)
+            if index is None or index["fingerprint"] != fingerprint:
+                # The profile changed, so answers in its old persona are stale
+                index = self._profiles[bundle.profile_id] = {"fingerprint": fingerprint, "entries": {}}
+            entries = index["entries"]
+            entries.pop(key, None)
+            if len(entries) >= self.max_entries:
+                for cached_key in [k for k, cached in entries.items() if cached["expires"] <= now]:
+                    del entries[cached_key]
+            while len(entries) >= self.max_entries:
+                # Dicts keep insertion order, so this evicts the oldest entry
+                del entries[next(iter(entries))]
+            entries[key] = entry
+        return entry
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": sum(len(index["entries"]) for index in self._profiles.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+response_cache = ResponseCache()
+
+
+def stream_cached_response(entry, cancel_token=None):
+    """Replay a cached answer: its text, then its audio (synthesized once if missing)"""
+    yield json.dumps({"type": "content", "text": entry["text"]}) + "\n"
+
+    if entry["audio"] is not None:
+        audio_id = str(uuid.uuid4())
+        audio_streams[audio_id] = (iter(entry["audio"]), cancel_token)
+    else:
+        audio_id = process_tts(entry["text"], cancel_token, on_complete=lambda chunks: entry.update(audio=chunks))
+    if audio_id:
+        yield json.dumps({"type": "audio", "id": audio_id}) + "\n"
+
+
+def generate_content(messages, bundle, cancel_token=None, speculate=False, use_cache=True):
+    # Inline profiles have no id and are never cached
+    query = messages[-1]["content"]
+    use_cache = use_cache and bundle.profile_id
+    if use_cache:
+        cached = response_cache.lookup(bundle, query)
+        if cached:
+            yield from stream_cached_response(cached, cancel_token)
+            return
 
-    response = completion(
+    messages[0]["content"] = bundle.render_prompt()
+
+    # Start the likely tool call while the model is still deciding
+    speculation = Speculation.start(query, bundle, cancel_token) if speculate else None
+    try:
+        yield from generate_model_response(messages, bundle, query, cancel_token, speculation, use_cache)
+    finally:
+        if speculation:
+            speculation.discard()
+
+
+def generate_model_response(messages, bundle, query, cancel_token=None, speculation=None, use_cache=False):
+    global CURRENT_MODEL
+    available_tools = list(bundle.tools)
+    response = call_upstream(
+        "llm",
+        cancel_token,
+        completion,
         model=CURRENT_MODEL,
+        timeout=UPSTREAM_TIMEOUT,
         messages=messages,
         tools=available_tools,
         tool_choice="auto" if available_tools else "none",
@@ -647,62 +1702,36 @@ def generate_content(messages, profile):
     if response.choices and response.choices[0].message:
         message = response.choices[0].message
         content = message.content or ""
+        function_name = None
         
         if message.tool_calls:
             tool_call = message.tool_calls[0]
             function_name = tool_call.function.name
             function_args = json.loads(tool_call.function.arguments)
-
-            if function_name == "get_current_weather" and profile["tools"].get("weather", True):
-                weather_result = get_current_weather(**function_args)
-                summary = summarize_tool_result("weather", weather_result, f"Weather in {function_args.get('location')}")
-                content += f"\n\n{summary}"
-
-            elif function_name == "query_wolfram_alpha" and profile["tools"].get("wolfram_alpha", True):
-                query = function_args["query"]
-                wolfram_result = query_wolfram_alpha(query)
-                summary = summarize_tool_result("Wolfram Alpha", wolfram_result, query)
-                content += f"\n\n{summary}"
-
-            elif function_name == "play_music" and profile["tools"].get("play_music", True):
-                song_name = function_args.get("song_name")
-                if song_name:
-                    play_result = play_music(song_name)
-                    content += f"\n\n{play_result}"
-
-            elif function_name == "pause_music" and profile["tools"].get("play_music", True):
-                pause_result = pause_music()
-                content += f"\n\n{pause_result}"
-
-            elif function_name == "download_audio" and profile["tools"].get("download_audio", True):
-                url = function_args["url"]
-                download_result = download_audio(url)
-                content += f"\n\n{download_result}"
-
-            elif function_name == "google_search" and profile["tools"].get("google_search", True):
-                query = function_args["query"]
-                search_results = google_search(query)
-                scraped_content = []
-                for result in search_results:
-                    title = result.get("title", "")
-                    url = result.get("link", "")
-                    snippet = result.get("snippet", "")
-                    content = scrape_content(url)
-                    scraped_content.append({
-                        "title": title,
-                        "url": url,
-                        "snippet": snippet,
-                        "content": content,
-                    })
-                search_result_json = json.dumps(scraped_content)
-                summary = summarize_tool_result("Google Search", search_result_json, query)
-                content += f"\n\n{summary}"
+            if cancel_token is not None:
+                cancel_token.raise_if_cancelled()
+
+            handler = bundle.dispatch.get(function_name)
+            if handler:
+                # Reuse the speculative result when the model asked for the same call
+                prefetched = speculation.claim(function_name, function_args, cancel_token) if speculation else None
+                if prefetched is not None:
+                    tool_result = handler(function_args, cancel_token, prefetched=prefetched)
+                else:
+                    tool_result = handler(function_args, cancel_token)
+                if tool_result:
+                    content += f"\n\n{tool_result}"
 
         # First, yield the text content
         yield json.dumps({"type": "content", "text": content}) + "\n"
 
+        cache_entry = None
+        if use_cache and content:
+            cache_entry = response_cache.store(bundle, query, content, function_name)
+
         # Then, process TTS and yield the audio_id
-        audio_id = process_tts(content)
+        on_complete = (lambda chunks: cache_entry.update(audio=chunks)) if cache_entry else None
+        audio_id = process_tts(content, cancel_token, on_complete)
         if audio_id:
             yield json.dumps({"type": "audio", "id": audio_id}) + "\n"
 
@@ -743,32 +1772,88 @@ def client_connect():
 def get_default_profile_route():
     return jsonify(get_default_profile())
 
+@app.route("/upstream_stats", methods=["GET"])
+def upstream_stats():
+    stats = {name: limiter.stats() for name, limiter in upstream_limiters.items()}
+    stats["response_cache"] = response_cache.stats()
+    stats["speculation"] = speculation_stats.stats()
+    return jsonify(stats)
+
+
+@app.route("/profiles", methods=["GET"])
+def list_profiles():
+    return jsonify({"profiles": profile_registry.ids()})
+
+
 @app.route("/generate", methods=["POST"])
 def generate():
     data = request.json
     message = data.get("message")
     conversation = data.get("conversation", [])
-    profile = data.get("profile", get_default_profile())
+    # Without a session id the request cannot be interrupted by, or interrupt, any other
+    session_id = data.get("session_id") or str(uuid.uuid4())
+    speculate = data.get("speculate", SPECULATION_ENABLED)
 
     if not message:
         return {"error": "No message provided"}, 400
 
-    # Get current time for system message
-    current_time = datetime.now()
-    formatted_date = current_time.strftime("%A, %B %d, %Y")
-    formatted_time = current_time.strftime("%I:%M %p")
+    # Prefer a registered profile id, falling back to a profile posted inline
+    profile_id = data.get("profile_id")
+    if profile_id:
+        bundle = profile_registry.get(profile_id)
+        if bundle is None:
+            return {"error": f"Unknown profile: {profile_id}"}, 404
+    elif "profile" in data:
+        bundle = compile_profile(data["profile"])
+    else:
+        bundle = get_default_bundle()
 
-    system_message = {
-        "role": "system",
-        "content": f"You are a helpful assistant with access to various data sources and computational capabilities. You can provide information on a wide range of topics and perform calculations. Always strive to give accurate and up-to-date information. The current time is {formatted_time} and the date is {formatted_date}.",
-    }
+    # The content is filled in from the profile by generate_content
+    system_message = {"role": "system", "content": ""}
 
     messages = [system_message] + conversation + [{"role": "user", "content": message}]
 
+    # A new message in the same session interrupts whatever is still running
+    cancel_token = start_generation(session_id)
+    output_queue = queue.Queue()
+
+    def run_generation():
+        try:
+            # Answers that may depend on earlier turns are neither served from nor stored in the cache
+            for item in generate_content(messages, bundle, cancel_token, speculate, use_cache=not conversation):
+                output_queue.put(item)
+        except GenerationCancelled:
+            print(f"[bold red]Generation cancelled for session {session_id}.[/bold red]")
+        except UpstreamBusy as e:
+            print(f"Upstream busy for session {session_id}: {e}")
+            output_queue.put(json.dumps({"type": "content", "text": "I'm handling a lot of requests right now, please try again in a moment."}) + "\n")
+        except Exception as e:
+            print(f"Error in generate_content: {e}")
+        finally:
+            output_queue.put(None)
+
+    threading.Thread(target=run_generation, daemon=True).start()
+
     def generate_response():
-        response = generate_content(messages, profile)
-        for item in response:
-            yield item
+        finished = False
+        try:
+            while True:
+                try:
+                    item = output_queue.get(timeout=HEARTBEAT_INTERVAL)
+                except queue.Empty:
+                    # Blank keep-alive lines surface a dropped client quickly
+                    yield "\n"
+                    continue
+                if item is None:
+                    finished = True
+                    break
+                yield item
+        finally:
+            if not finished:
+                # Client went away mid-stream, abort all upstream work
+                cancel_token.cancel()
+                drop_cancelled_audio_streams()
+            finish_generation(session_id, cancel_token)
 
     return Response(generate_response(), mimetype="text/event-stream")
 
@@ -776,22 +1861,30 @@ def generate():
 # Add this new route to main.py
 @app.route("/stop_audio", methods=["POST"])
 def stop_audio():
-    stop_audio_stream()
+    data = request.get_json(silent=True) or {}
+    if data.get("session_id"):
+        cancel_generations(data["session_id"])
+    # Barge-in only silences the assistant, so music keeps playing
+    if data.get("stop_music", True):
+        stop_audio_stream()
     return {"status": "Audio stopped"}, 200
 
 
-# Modify the stop_audio_stream function
 def stop_audio_stream():
-    # This function is now a placeholder, as the audio streaming is handled differently
+    """Stop local music playback"""
+    global audio_stream
+    audio_stream = None
+    audio_paused.clear()
+    if audio_thread and audio_thread is not threading.current_thread():
+        audio_thread.join(timeout=1)
     print("[bold red]Audio stream stopped.[/bold red]")
 
-async def close_cartesia_client():
-    await client.close()
-
 @app.route("/disconnect", methods=["POST"])
 def disconnect():
+    data = request.get_json(silent=True) or {}
+    if data.get("session_id"):
+        cancel_generations(data["session_id"])
     stop_audio_stream()
-    asyncio.run(close_cartesia_client())
     return {"status": "disconnected"}, 200
 
 @app.route('/')
@@ -799,11 +1892,15 @@ def serve_voice_assistant():
     return send_file('main.html')
 
 def run_app():
+    tts_pool.start()
+    profile_registry.start()
     try:
         run_simple("127.0.0.1", 5000, app, use_reloader=False, use_debugger=True)
     except KeyboardInterrupt:
         print("[bold red]Server is shutting down...[/bold red]")
+        cancel_generations()
         stop_audio_stream()  # Stop the audio stream on server shutdown
+        tts_pool.close()
 
 
 if __name__ == "__main__":
@@ -814,8 +1911,21 @@ if __name__ == "__main__":
         default=CURRENT_MODEL,
         help="Specify the model to use (default: %(default)s)",
     )
+    parser.add_argument(
+        "--profiles-dir",
+        type=str,
+        default=profile_registry.directory,
+        help="Directory of profile JSON files served by id (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--speculate",
+        action="store_true",
+        help="Start likely tool calls (weather, search) alongside the first model call",
+    )
     args = parser.parse_args()
 
     CURRENT_MODEL = args.model
+    SPECULATION_ENABLED = args.speculate
+    profile_registry.directory = args.profiles_dir
     display_startup_messages()
     run_app()